@@ -1,10 +1,109 @@
+import binascii
+import functools
 import itertools
+import mmap
+import os
+import stat
 import sys
 import struct
-from io import open, BytesIO, SEEK_CUR, SEEK_END  # noqa
+from io import open, BytesIO, FileIO, SEEK_SET, SEEK_CUR, SEEK_END  # noqa
 
 PY2 = sys.version_info[0] == 2
 
+# Python 2 vs 3 specific helpers, picked once at import time so that the
+# code using them doesn't need to check PY2 on every call
+if PY2:
+    def _int_from_bytes_be(buf):
+        return int(binascii.hexlify(buf), 16)
+
+    def _int_from_bytes_le(buf):
+        return int(binascii.hexlify(buf[::-1]), 16)
+
+    def _xor_one(data, key):
+        return bytes(bytearray(v ^ key for v in bytearray(data)))
+
+    def _xor_many(data, key):
+        return bytes(bytearray(a ^ b for a, b in zip(bytearray(data), itertools.cycle(bytearray(key)))))
+else:
+    _int_from_bytes_be = functools.partial(int.from_bytes, byteorder='big')
+    _int_from_bytes_le = functools.partial(int.from_bytes, byteorder='little')
+
+    # XOR as one arbitrary-precision integer operation, which runs in C,
+    # instead of a generator XORing byte after byte
+    def _xor_one(data, key):
+        n = len(data)
+        x = int.from_bytes(data, 'little') ^ int.from_bytes(bytes((key,)) * n, 'little')
+        return x.to_bytes(n, 'little')
+
+    def _xor_many(data, key):
+        n = len(data)
+        if not key:
+            return b''
+        # bytes() first: memoryview keys can't be repeated
+        key_data = (bytes(key) * -(-n // len(key)))[:n]
+        x = int.from_bytes(data, 'little') ^ int.from_bytes(key_data, 'little')
+        return x.to_bytes(n, 'little')
+
+
+def _eof_error(requested, got):
+    return EOFError(
+        "requested %d bytes, but got only %d bytes" %
+        (requested, got)
+    )
+
+
+# Pre-bound Struct.unpack of every fixed-width type, used by
+# read_[suf]*: a global lookup instead of two attribute lookups per call
+_unpack_s2be = struct.Struct('>h').unpack
+_unpack_s4be = struct.Struct('>i').unpack
+_unpack_s8be = struct.Struct('>q').unpack
+_unpack_s2le = struct.Struct('<h').unpack
+_unpack_s4le = struct.Struct('<i').unpack
+_unpack_s8le = struct.Struct('<q').unpack
+
+_unpack_u2be = struct.Struct('>H').unpack
+_unpack_u4be = struct.Struct('>I').unpack
+_unpack_u8be = struct.Struct('>Q').unpack
+_unpack_u2le = struct.Struct('<H').unpack
+_unpack_u4le = struct.Struct('<I').unpack
+_unpack_u8le = struct.Struct('<Q').unpack
+
+_unpack_f4be = struct.Struct('>f').unpack
+_unpack_f8be = struct.Struct('>d').unpack
+_unpack_f4le = struct.Struct('<f').unpack
+_unpack_f8le = struct.Struct('<d').unpack
+
+# Initial size of the buffer used by read_bytes_into() by default
+_READ_BUF_MIN_SIZE = 4096
+
+# numpy is optional, and importing it takes many times longer than
+# importing this module, so it's only imported on first use, by _numpy():
+# None until then, False if it isn't installed
+_np = None
+
+
+def _numpy():
+    global _np
+    if _np is None:
+        try:
+            import numpy
+            _np = numpy
+        except ImportError:
+            _np = False
+    return _np or None
+
+
+# Inputs shorter than this are processed in pure Python even if numpy is
+# available: for them, setting up arrays costs more than it saves.
+_NUMPY_MIN_SIZE = 64
+
+# Size of the blocks read_bytes_term() reads while looking for a terminator
+_TERM_SCAN_CHUNK_SIZE = 4096
+
+# Translation tables for process_rotate_left, built on demand, keyed by
+# rotation amount
+_rotate_left_tables = {}
+
 # Kaitai Struct runtime streaming API version, defined as per PEP-0396
 # standard. Used for two purposes:
 #
@@ -30,7 +129,9 @@ class KaitaiStruct(object):
 
     @classmethod
     def from_file(cls, filename):
-        f = open(filename, 'rb')
+        # Larger than the default buffer, to cut down on read() system
+        # calls, but still small enough not to penalize seeking around
+        f = open(filename, 'rb', buffering=64 * 1024)
         try:
             return cls(KaitaiStream(f))
         except Exception:
@@ -38,8 +139,42 @@ class KaitaiStruct(object):
             f.close()
             raise
 
+    @classmethod
+    def from_file_mmap(cls, filename):
+        """Same as from_file(), but maps the file into memory and parses
+        it from there, which avoids read() system calls and copying data
+        through a file buffer. On Python 2, where mmap objects can't be
+        viewed through memoryview, this just falls back to from_file().
+        """
+        if PY2:
+            return cls.from_file(filename)
+        with open(filename, 'rb') as f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                return cls.from_bytes(b'')
+        reader = _MemReader(m, owner=m)
+        try:
+            return cls(KaitaiStream(reader))
+        except Exception:
+            # unmap the file, then reraise the exception
+            reader.close()
+            raise
+
     @classmethod
     def from_bytes(cls, buf):
+        """Parses given bytes-like object. A memoryview is parsed in place
+        instead of being copied first (except on Python 2), so the parsed
+        object keeps a live view of the underlying buffer for as long as
+        it exists: e.g. a bytearray behind the view can't be resized
+        meanwhile (BufferError), and changes made to it show up in
+        anything parsed later, such as lazily parsed instances. Pass
+        bytes(view) instead to parse a snapshot.
+        """
+        if not PY2 and isinstance(buf, memoryview):
+            # BytesIO would copy the whole viewed buffer up front
+            return cls(KaitaiStream(_MemReader(buf)))
         return cls(KaitaiStream(BytesIO(buf)))
 
     @classmethod
@@ -50,7 +185,15 @@ class KaitaiStruct(object):
 class KaitaiStream(object):
     def __init__(self, io):
         self._io = io
-        self.align_to_byte()
+        # Same initial state as align_to_byte() sets, without the call
+        self.bits = 0
+        self.bits_left = 0
+
+    # Stream size, once known (see size())
+    _size = None
+    # Buffer reused by read_bytes_into() when no buffer is given,
+    # allocated on first use
+    _read_buf = None
 
     def __enter__(self):
         return self
@@ -70,6 +213,25 @@ class KaitaiStream(object):
             return False
 
         io = self._io
+        # Fast path: before the end of the stream, there's surely more to
+        # read. Only seekable streams can tell their size; ones without
+        # seekable() (e.g. Python 2 files) are assumed not to.
+        if self._size is None:
+            seekable = getattr(io, 'seekable', None)
+            has_size = seekable is not None and seekable()
+        else:
+            has_size = True
+        if has_size:
+            try:
+                if io.tell() < self.size():
+                    return False
+            except (IOError, OSError):
+                # Some pseudo files (e.g. /proc/cpuinfo) can't seek to
+                # their end, so size() fails for them
+                pass
+
+        # At or past the end, the size may be wrong (procfs files report
+        # 0) or stale (the file grew since), so check by reading a byte
         t = io.read(1)
         if t == b'':
             return True
@@ -84,134 +246,300 @@ class KaitaiStream(object):
         return self._io.tell()
 
     def size(self):
-        # Python has no internal File object API function to get
-        # current file / StringIO size, thus we use the following
-        # trick.
-        io = self._io
-        # Remember our current position
-        cur_pos = io.tell()
-        # Seek to the end of the File object
-        io.seek(0, SEEK_END)
-        # Remember position, which is equal to the full length
-        full_size = io.tell()
-        # Seek back to the current position
-        io.seek(cur_pos)
-        return full_size
+        # Streams are read-only, so the size can't change once known
+        if self._size is None:
+            io = self._io
+            raw = getattr(io, 'raw', io)
+            if isinstance(raw, FileIO):
+                st = os.fstat(raw.fileno())
+                # Files on disk know their size, no need to seek. Pseudo
+                # files (e.g. in procfs) report 0 whatever their content,
+                # so leave these to the seek trick below.
+                if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                    self._size = st.st_size
+                    return self._size
+            elif not PY2 and isinstance(io, BytesIO):
+                self._size = len(io.getbuffer())
+                return self._size
+
+            # Python has no internal File object API function to get
+            # current file / StringIO size, thus we use the following
+            # trick.
+            # Remember our current position
+            cur_pos = io.tell()
+            # Seek to the end of the File object
+            io.seek(0, SEEK_END)
+            # Remember position, which is equal to the full length
+            self._size = io.tell()
+            # Seek back to the current position
+            io.seek(cur_pos)
+        return self._size
 
     # ========================================================================
     # Integer numbers
     # ========================================================================
 
-    packer_s1 = struct.Struct('b')
-    packer_s2be = struct.Struct('>h')
-    packer_s4be = struct.Struct('>i')
-    packer_s8be = struct.Struct('>q')
-    packer_s2le = struct.Struct('<h')
-    packer_s4le = struct.Struct('<i')
-    packer_s8le = struct.Struct('<q')
-
-    packer_u1 = struct.Struct('B')
-    packer_u2be = struct.Struct('>H')
-    packer_u4be = struct.Struct('>I')
-    packer_u8be = struct.Struct('>Q')
-    packer_u2le = struct.Struct('<H')
-    packer_u4le = struct.Struct('<I')
-    packer_u8le = struct.Struct('<Q')
-
     # ------------------------------------------------------------------------
     # Signed
     # ------------------------------------------------------------------------
 
     def read_s1(self):
-        return KaitaiStream.packer_s1.unpack(self.read_bytes(1))[0]
+        r = self._io.read(1)
+        if not r:
+            raise _eof_error(1, 0)
+        v = ord(r)
+        return v - 256 if v >= 128 else v
 
     # ........................................................................
     # Big-endian
     # ........................................................................
 
     def read_s2be(self):
-        return KaitaiStream.packer_s2be.unpack(self.read_bytes(2))[0]
+        r = self._io.read(2)
+        if len(r) < 2:
+            raise _eof_error(2, len(r))
+        return _unpack_s2be(r)[0]
 
     def read_s4be(self):
-        return KaitaiStream.packer_s4be.unpack(self.read_bytes(4))[0]
+        r = self._io.read(4)
+        if len(r) < 4:
+            raise _eof_error(4, len(r))
+        return _unpack_s4be(r)[0]
 
     def read_s8be(self):
-        return KaitaiStream.packer_s8be.unpack(self.read_bytes(8))[0]
+        r = self._io.read(8)
+        if len(r) < 8:
+            raise _eof_error(8, len(r))
+        return _unpack_s8be(r)[0]
 
     # ........................................................................
     # Little-endian
     # ........................................................................
 
     def read_s2le(self):
-        return KaitaiStream.packer_s2le.unpack(self.read_bytes(2))[0]
+        r = self._io.read(2)
+        if len(r) < 2:
+            raise _eof_error(2, len(r))
+        return _unpack_s2le(r)[0]
 
     def read_s4le(self):
-        return KaitaiStream.packer_s4le.unpack(self.read_bytes(4))[0]
+        r = self._io.read(4)
+        if len(r) < 4:
+            raise _eof_error(4, len(r))
+        return _unpack_s4le(r)[0]
 
     def read_s8le(self):
-        return KaitaiStream.packer_s8le.unpack(self.read_bytes(8))[0]
+        r = self._io.read(8)
+        if len(r) < 8:
+            raise _eof_error(8, len(r))
+        return _unpack_s8le(r)[0]
 
     # ------------------------------------------------------------------------
     # Unsigned
     # ------------------------------------------------------------------------
 
     def read_u1(self):
-        return KaitaiStream.packer_u1.unpack(self.read_bytes(1))[0]
+        r = self._io.read(1)
+        if not r:
+            raise _eof_error(1, 0)
+        return ord(r)
 
     # ........................................................................
     # Big-endian
     # ........................................................................
 
     def read_u2be(self):
-        return KaitaiStream.packer_u2be.unpack(self.read_bytes(2))[0]
+        r = self._io.read(2)
+        if len(r) < 2:
+            raise _eof_error(2, len(r))
+        return _unpack_u2be(r)[0]
 
     def read_u4be(self):
-        return KaitaiStream.packer_u4be.unpack(self.read_bytes(4))[0]
+        r = self._io.read(4)
+        if len(r) < 4:
+            raise _eof_error(4, len(r))
+        return _unpack_u4be(r)[0]
 
     def read_u8be(self):
-        return KaitaiStream.packer_u8be.unpack(self.read_bytes(8))[0]
+        r = self._io.read(8)
+        if len(r) < 8:
+            raise _eof_error(8, len(r))
+        return _unpack_u8be(r)[0]
 
     # ........................................................................
     # Little-endian
     # ........................................................................
 
     def read_u2le(self):
-        return KaitaiStream.packer_u2le.unpack(self.read_bytes(2))[0]
+        r = self._io.read(2)
+        if len(r) < 2:
+            raise _eof_error(2, len(r))
+        return _unpack_u2le(r)[0]
 
     def read_u4le(self):
-        return KaitaiStream.packer_u4le.unpack(self.read_bytes(4))[0]
+        r = self._io.read(4)
+        if len(r) < 4:
+            raise _eof_error(4, len(r))
+        return _unpack_u4le(r)[0]
 
     def read_u8le(self):
-        return KaitaiStream.packer_u8le.unpack(self.read_bytes(8))[0]
+        r = self._io.read(8)
+        if len(r) < 8:
+            raise _eof_error(8, len(r))
+        return _unpack_u8le(r)[0]
 
     # ========================================================================
     # Floating point numbers
     # ========================================================================
 
-    packer_f4be = struct.Struct('>f')
-    packer_f8be = struct.Struct('>d')
-    packer_f4le = struct.Struct('<f')
-    packer_f8le = struct.Struct('<d')
-
     # ........................................................................
     # Big-endian
     # ........................................................................
 
     def read_f4be(self):
-        return KaitaiStream.packer_f4be.unpack(self.read_bytes(4))[0]
+        r = self._io.read(4)
+        if len(r) < 4:
+            raise _eof_error(4, len(r))
+        return _unpack_f4be(r)[0]
 
     def read_f8be(self):
-        return KaitaiStream.packer_f8be.unpack(self.read_bytes(8))[0]
+        r = self._io.read(8)
+        if len(r) < 8:
+            raise _eof_error(8, len(r))
+        return _unpack_f8be(r)[0]
 
     # ........................................................................
     # Little-endian
     # ........................................................................
 
     def read_f4le(self):
-        return KaitaiStream.packer_f4le.unpack(self.read_bytes(4))[0]
+        r = self._io.read(4)
+        if len(r) < 4:
+            raise _eof_error(4, len(r))
+        return _unpack_f4le(r)[0]
 
     def read_f8le(self):
-        return KaitaiStream.packer_f8le.unpack(self.read_bytes(8))[0]
+        r = self._io.read(8)
+        if len(r) < 8:
+            raise _eof_error(8, len(r))
+        return _unpack_f8le(r)[0]
+
+    # ========================================================================
+    # Several numbers at once
+    # ========================================================================
+
+    def read_struct(self, fmt):
+        """Reads consecutive fixed-width numbers described by a struct
+        module format string (e.g. '>HIIQ') with a single read, and
+        returns them as a tuple. Compiled formats are cached by the
+        struct module itself.
+        """
+        return struct.unpack(fmt, self.read_bytes(struct.calcsize(fmt)))
+
+    # ========================================================================
+    # Arrays of numbers
+    # ========================================================================
+
+    def _read_array(self, n, item_size, fmt):
+        """Reads n consecutive numbers at once and returns them as a list,
+        unpacked with given struct format (one type character, with
+        optional byte order prefix).
+        """
+        buf = self.read_bytes(n * item_size)
+        return list(struct.unpack(fmt[:-1] + str(n) + fmt[-1], buf))
+
+    def read_ndarray(self, n, dtype):
+        """Reads n consecutive numbers at once as a read-only numpy array
+        of given dtype (e.g. '<u4'), viewing the bytes read without
+        copying them. Requires numpy.
+        """
+        np = _numpy()
+        if np is None:
+            raise ImportError("read_ndarray() requires numpy")
+        dtype = np.dtype(dtype)
+        return np.frombuffer(self.read_bytes(n * dtype.itemsize), dtype=dtype)
+
+    # ------------------------------------------------------------------------
+    # Signed
+    # ------------------------------------------------------------------------
+
+    def read_s1_arr(self, n):
+        return self._read_array(n, 1, 'b')
+
+    # ........................................................................
+    # Big-endian
+    # ........................................................................
+
+    def read_s2be_arr(self, n):
+        return self._read_array(n, 2, '>h')
+
+    def read_s4be_arr(self, n):
+        return self._read_array(n, 4, '>i')
+
+    def read_s8be_arr(self, n):
+        return self._read_array(n, 8, '>q')
+
+    # ........................................................................
+    # Little-endian
+    # ........................................................................
+
+    def read_s2le_arr(self, n):
+        return self._read_array(n, 2, '<h')
+
+    def read_s4le_arr(self, n):
+        return self._read_array(n, 4, '<i')
+
+    def read_s8le_arr(self, n):
+        return self._read_array(n, 8, '<q')
+
+    # ------------------------------------------------------------------------
+    # Unsigned
+    # ------------------------------------------------------------------------
+
+    def read_u1_arr(self, n):
+        return self._read_array(n, 1, 'B')
+
+    # ........................................................................
+    # Big-endian
+    # ........................................................................
+
+    def read_u2be_arr(self, n):
+        return self._read_array(n, 2, '>H')
+
+    def read_u4be_arr(self, n):
+        return self._read_array(n, 4, '>I')
+
+    def read_u8be_arr(self, n):
+        return self._read_array(n, 8, '>Q')
+
+    # ........................................................................
+    # Little-endian
+    # ........................................................................
+
+    def read_u2le_arr(self, n):
+        return self._read_array(n, 2, '<H')
+
+    def read_u4le_arr(self, n):
+        return self._read_array(n, 4, '<I')
+
+    def read_u8le_arr(self, n):
+        return self._read_array(n, 8, '<Q')
+
+    # ------------------------------------------------------------------------
+    # Floating point
+    # ------------------------------------------------------------------------
+
+    def read_f4be_arr(self, n):
+        return self._read_array(n, 4, '>f')
+
+    def read_f8be_arr(self, n):
+        return self._read_array(n, 8, '>d')
+
+    def read_f4le_arr(self, n):
+        return self._read_array(n, 4, '<f')
+
+    def read_f8le_arr(self, n):
+        return self._read_array(n, 8, '<d')
 
     # ========================================================================
     # Unaligned bit values
@@ -222,28 +550,27 @@ class KaitaiStream(object):
         self.bits_left = 0
 
     def read_bits_int_be(self, n):
-        bits_needed = n - self.bits_left
+        # Work on local copies of the bit buffer state and store it back
+        # once, rather than going through attributes at every step
+        bits = self.bits
+        bits_left = self.bits_left
+        bits_needed = n - bits_left
         if bits_needed > 0:
             # 1 bit  => 1 byte
             # 8 bits => 1 byte
             # 9 bits => 2 bytes
             bytes_needed = ((bits_needed - 1) // 8) + 1
             buf = self.read_bytes(bytes_needed)
-            for byte in buf:
-                byte = KaitaiStream.int_from_byte(byte)
-                self.bits <<= 8
-                self.bits |= byte
-                self.bits_left += 8
-
-        # raw mask with required number of 1s, starting from lowest bit
-        mask = (1 << n) - 1
-        # shift self.bits to align the highest bits with the mask & derive reading result
-        shift_bits = self.bits_left - n
-        res = (self.bits >> shift_bits) & mask
+            bits = (bits << (bytes_needed * 8)) | _int_from_bytes_be(buf)
+            bits_left += bytes_needed * 8
+
+        # shift bits to align the highest bits with a mask of n 1s
+        # (starting from lowest bit) & derive reading result
+        bits_left -= n
+        res = (bits >> bits_left) & ((1 << n) - 1)
         # clear top bits that we've just read => AND with 1s
-        self.bits_left -= n
-        mask = (1 << self.bits_left) - 1
-        self.bits &= mask
+        self.bits = bits & ((1 << bits_left) - 1)
+        self.bits_left = bits_left
 
         return res
 
@@ -253,25 +580,24 @@ class KaitaiStream(object):
         return self.read_bits_int_be(n)
 
     def read_bits_int_le(self, n):
-        bits_needed = n - self.bits_left
+        bits = self.bits
+        bits_left = self.bits_left
+        bits_needed = n - bits_left
         if bits_needed > 0:
             # 1 bit  => 1 byte
             # 8 bits => 1 byte
             # 9 bits => 2 bytes
             bytes_needed = ((bits_needed - 1) // 8) + 1
             buf = self.read_bytes(bytes_needed)
-            for byte in buf:
-                byte = KaitaiStream.int_from_byte(byte)
-                self.bits |= (byte << self.bits_left)
-                self.bits_left += 8
-
-        # raw mask with required number of 1s, starting from lowest bit
-        mask = (1 << n) - 1
-        # derive reading result
-        res = self.bits & mask
+            bits |= _int_from_bytes_le(buf) << bits_left
+            bits_left += bytes_needed * 8
+
+        # derive reading result with a raw mask of n 1s, starting from
+        # lowest bit
+        res = bits & ((1 << n) - 1)
         # remove bottom bits that we've just read by shifting
-        self.bits >>= n
-        self.bits_left -= n
+        self.bits = bits >> n
+        self.bits_left = bits_left - n
 
         return res
 
@@ -287,35 +613,111 @@ class KaitaiStream(object):
             )
         r = self._io.read(n)
         if len(r) < n:
-            raise EOFError(
-                "requested %d bytes, but got only %d bytes" %
-                (n, len(r))
-            )
+            raise _eof_error(n, len(r))
         return r
 
+    def read_bytes_into(self, n, buf=None):
+        """Reads exactly n bytes into the start of given writable buffer
+        (e.g. a bytearray) instead of allocating a new bytes object, and
+        returns a memoryview of these n bytes. The view shares memory with
+        buf: it's only valid until buf is filled again, and must be copied
+        (e.g. with bytes()) to be retained.
+
+        Without buf, a buffer owned by the stream is used, so the view is
+        only valid until the next read_bytes_into() call on this stream.
+        """
+        if n < 0:
+            raise ValueError(
+                "requested invalid %d amount of bytes" %
+                (n,)
+            )
+        if buf is None:
+            buf = self._read_buf
+            if buf is None or len(buf) < n:
+                buf = self._read_buf = bytearray(max(n, _READ_BUF_MIN_SIZE))
+        mv = memoryview(buf)
+        if mv.itemsize != 1 or mv.ndim != 1:
+            # Slicing counts items (or rows), not bytes: view buf as a
+            # flat sequence of bytes instead, e.g. for array.array('I')
+            mv = mv.cast('B')
+        mv = mv[:n]
+        if len(mv) < n:
+            raise ValueError(
+                "requested %d bytes, but buffer only holds %d bytes" %
+                (n, len(mv))
+            )
+        readinto = getattr(self._io, 'readinto', None)
+        if readinto is not None:
+            got = readinto(mv)
+        else:
+            # Streams are only required to have read()
+            r = self._io.read(n)
+            got = len(r)
+            mv[:got] = r
+        if got < n:
+            raise _eof_error(n, got)
+        return mv
+
     def read_bytes_full(self):
         return self._io.read()
 
     def read_bytes_term(self, term, include_term, consume_term, eos_error):
-        r = b''
+        return self._read_bytes_term(KaitaiStream.byte_from_int(term), include_term, consume_term, eos_error)
+
+    def read_bytes_term_zero(self, include_term, consume_term, eos_error):
+        """Same as read_bytes_term(0, ...), i.e. reads a C-style
+        NUL-terminated string, without building the terminator each time.
+        """
+        return self._read_bytes_term(b'\x00', include_term, consume_term, eos_error)
+
+    def _read_bytes_term(self, term_byte, include_term, consume_term, eos_error):
+        io = self._io
+        # Buffered streams (e.g. from_file()'s BufferedReader, GzipFile)
+        # can look ahead with peek() and only consume what's needed.
+        # Others are read ahead in blocks if they can seek back over what's
+        # past the terminator, or else read byte by byte.
+        peek = getattr(io, 'peek', None)
+        if peek is not None:
+            block_size = _TERM_SCAN_CHUNK_SIZE
+        else:
+            seekable = getattr(io, 'seekable', None)
+            if seekable is not None and seekable():
+                block_size = _TERM_SCAN_CHUNK_SIZE
+            else:
+                block_size = 1
+
+        r = bytearray()
         while True:
-            c = self._io.read(1)
-            if c == b'':
+            chunk = peek(block_size) if peek is not None else io.read(block_size)
+            if not chunk:
                 if eos_error:
                     raise Exception(
                         "end of stream reached, but no terminator %d found" %
-                        (term,)
+                        (ord(term_byte),)
                     )
                 else:
-                    return r
-            elif ord(c) == term:
-                if include_term:
-                    r += c
-                if not consume_term:
-                    self._io.seek(-1, SEEK_CUR)
-                return r
-            else:
-                r += c
+                    return bytes(r)
+
+            idx = chunk.find(term_byte)
+            if idx < 0:
+                if peek is not None:
+                    io.read(len(chunk))
+                r += chunk
+                continue
+
+            # Consume everything up to the terminator, and the terminator
+            # itself if requested
+            used = idx + 1 if consume_term else idx
+            if peek is not None:
+                io.read(used)
+            elif used != len(chunk):
+                io.seek(used - len(chunk), SEEK_CUR)
+
+            end = idx + 1 if include_term else idx
+            if not r:
+                return chunk[:end]
+            r += chunk[:end]
+            return bytes(r)
 
     def ensure_fixed_contents(self, expected):
         actual = self._io.read(len(expected))
@@ -324,7 +726,8 @@ class KaitaiStream(object):
                 "unexpected fixed contents: got %r, was waiting for %r" %
                 (actual, expected)
             )
-        return actual
+        # Equal anyway; lets the freshly read copy be freed right away
+        return expected
 
     @staticmethod
     def bytes_strip_right(data, pad_byte):
@@ -332,10 +735,10 @@ class KaitaiStream(object):
 
     @staticmethod
     def bytes_terminate(data, term, include_term):
-        new_data, term_byte, _ = data.partition(KaitaiStream.byte_from_int(term))
-        if include_term:
-            new_data += term_byte
-        return new_data
+        term_index = data.find(KaitaiStream.byte_from_int(term))
+        if term_index == -1:
+            return data[:]
+        return data[:term_index + 1 if include_term else term_index]
 
     # ========================================================================
     # Byte array processing
@@ -343,17 +746,36 @@ class KaitaiStream(object):
 
     @staticmethod
     def process_xor_one(data, key):
-        if PY2:
-            return bytes(bytearray(v ^ key for v in bytearray(data)))
+        np = _numpy() if len(data) >= _NUMPY_MIN_SIZE else None
+        if np is not None:
+            return (np.frombuffer(data, dtype=np.uint8) ^ np.uint8(key)).tobytes()
+        return _xor_one(data, key)
+
+    @staticmethod
+    def process_xor_one_inplace(buf, key):
+        """Same as process_xor_one(), but XORs a writable buffer (e.g. a
+        bytearray) in place instead of returning a new bytes object.
+        """
+        np = _numpy() if len(buf) >= _NUMPY_MIN_SIZE else None
+        if np is not None:
+            arr = np.frombuffer(buf, dtype=np.uint8)
+            np.bitwise_xor(arr, np.uint8(key), out=arr)
         else:
-            return bytes(v ^ key for v in data)
+            buf[:] = _xor_one(buf, key)
 
     @staticmethod
     def process_xor_many(data, key):
-        if PY2:
-            return bytes(bytearray(a ^ b for a, b in zip(bytearray(data), itertools.cycle(bytearray(key)))))
-        else:
-            return bytes(a ^ b for a, b in zip(data, itertools.cycle(key)))
+        np = _numpy() if len(data) >= _NUMPY_MIN_SIZE and len(key) > 0 else None
+        if np is not None:
+            # Repeating the key as bytes is a series of memcpy()s, much
+            # cheaper than np.tile() when the key is short; memoryviews
+            # can't be repeated, so normalise to bytes first
+            if not isinstance(key, bytes):
+                key = bytes(bytearray(key))
+            reps = -(-len(data) // len(key))
+            key_arr = np.frombuffer(key * reps, dtype=np.uint8, count=len(data))
+            return (np.frombuffer(data, dtype=np.uint8) ^ key_arr).tobytes()
+        return _xor_many(data, key)
 
     @staticmethod
     def process_rotate_left(data, amount, group_size):
@@ -363,27 +785,45 @@ class KaitaiStream(object):
                 (group_size,)
             )
 
-        mask = group_size * 8 - 1
-        anti_amount = -amount & mask
-
-        r = bytearray(data)
-        for i in range(len(r)):
-            r[i] = (r[i] << amount) & 0xff | (r[i] >> anti_amount)
-        return bytes(r)
+        if not isinstance(data, (bytes, bytearray)):
+            # Any other buffer (e.g. a memoryview from read_bytes_into()),
+            # which has no translate()
+            data = bytearray(data)
+        if amount == 0:
+            return bytes(data)
+
+        table = _rotate_left_tables.get(amount)
+        if table is None:
+            mask = group_size * 8 - 1
+            anti_amount = -amount & mask
+            table = bytes(bytearray(
+                (i << amount) & 0xff | (i >> anti_amount) for i in range(256)
+            ))
+            _rotate_left_tables[amount] = table
+        return bytes(data.translate(table))
 
     # ========================================================================
     # Misc
     # ========================================================================
 
-    @staticmethod
-    def int_from_byte(v):
-        if PY2:
+    # Python 2 vs 3 differences are resolved once, when the class is
+    # defined, rather than on every call
+    if PY2:
+        @staticmethod
+        def int_from_byte(v):
             return ord(v)
-        return v
 
-    @staticmethod
-    def byte_from_int(i):
-        return chr(i) if PY2 else bytes([i])
+        @staticmethod
+        def byte_from_int(i):
+            return chr(i)
+    else:
+        @staticmethod
+        def int_from_byte(v):
+            return v
+
+        @staticmethod
+        def byte_from_int(i):
+            return bytes([i])
 
     @staticmethod
     def byte_array_index(data, i):
@@ -409,6 +849,63 @@ class KaitaiStream(object):
             return value
 
 
+class _MemReader(object):
+    """Read-only, seekable file-like object over an existing buffer.
+    Unlike BytesIO, it never copies the buffer as a whole: only the parts
+    actually read are. Python 3 only.
+    """
+    __slots__ = ('_buf', '_pos', '_owner')
+
+    def __init__(self, buf, owner=None):
+        self._buf = memoryview(buf).cast('B')
+        self._pos = 0
+        # object to close along with the reader, if any
+        self._owner = owner
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, n=-1):
+        pos = self._pos
+        if n is None or n < 0:
+            r = self._buf[pos:].tobytes()
+        else:
+            r = self._buf[pos:pos + n].tobytes()
+        self._pos = pos + len(r)
+        return r
+
+    def readinto(self, b):
+        pos = self._pos
+        chunk = self._buf[pos:pos + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self._pos = pos + n
+        return n
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self._pos
+        elif whence == SEEK_END:
+            offset += len(self._buf)
+        elif whence != SEEK_SET:
+            raise ValueError("invalid whence (%r)" % (whence,))
+        if offset < 0:
+            raise ValueError("negative seek value %d" % (offset,))
+        self._pos = offset
+        return offset
+
+    def close(self):
+        self._buf.release()
+        if self._owner is not None:
+            self._owner.close()
+
+
 class KaitaiStructError(Exception):
     """Common ancestor for all error originating from Kaitai Struct usage.
     Stores KSY source path, pointing to an element supposedly guilty of